@@ -3,15 +3,27 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import multiprocessing
 import os, os.path
 import re
 import sys
 import samweb_client as swc
 import json
+try:
+    # orjson is a lot quicker than json at parsing the many small
+    # responses we get from dcache, but is optional
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import subprocess
 import shlex
+import threading
+import time
 import pycurl
+from collections import deque
 from io import BytesIO
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 
 # Check if X509_USER_PROXY is already set in the environment first and use it if so.
@@ -24,38 +36,197 @@ PNFS_DIR_PATTERN = re.compile(r"/pnfs/(?P<area>[^/]+)")
 # samweb.listFilesAndLocations()), so we make that part optional,
 # which gets us this unreadable re
 ENSTORE_PATTERN = re.compile(r"^enstore:([^(]+)(\([^)]+\))?")
+# The only two fields we want out of dcache's description of a file.
+# Their values are plain words like "ONLINE_AND_NEARLINE" or
+# "disk+tape", so there are no escaped quotes to worry about
+FILE_LOCALITY_PATTERN = re.compile(br'"fileLocality"\s*:\s*"([^"]*)"')
+TARGET_QOS_PATTERN = re.compile(br'"targetQos"\s*:\s*"([^"]*)"')
 # The base URL for the Fermilab instance of the dcache REST API.
 #
 # We use this for finding the online status of files and for requesting prestaging. The full dcache REST API is described in the dcache User Guide:
 #
 # https://www.dcache.org/manuals/UserGuide-6.0/frontend.shtml
 DCACHE_REST_BASE_URL = "https://fndca.fnal.gov:3880/api/v1/namespace"
+# The pieces that go either side of a namespace path to make the URLs
+# we request. We build a URL per file, so put them together once here
+_NAMESPACE_URL_PREFIX = DCACHE_REST_BASE_URL + "/"
+_QOS_URL_SUFFIX = "?qos=true&locality=true"
+_DIR_QOS_URL_SUFFIX = "?children=true&qos=true&locality=true"
+# The dcache bulk request API, which lets us ask for many files to be
+# prestaged in one request. See:
+#
+# https://www.dcache.org/manuals/UserGuide-8.2/frontend.shtml#bulk-requests
+DCACHE_BULK_REQUESTS_URL = "https://fndca.fnal.gov:3880/api/v1/bulk-requests"
+# How many files we put in each bulk request
+BULK_PRESTAGE_CHUNK = 1000
+# dcache accepting a bulk request means it has accepted the QoS change
+# for every file in it, except that some files might be rejected
+# shortly afterwards (eg, because they don't exist). So we watch the
+# request for a little while to catch those, but don't wait for dcache
+# to actually get round to the files: with a big request, most of them
+# will be queued for a long time. This is how long we watch for
+# failures, and how often we look, in seconds
+BULK_STARTED_STATES = ("RUNNING", "COMPLETED")
+BULK_FAILED_STATES = ("FAILED", "CANCELLED", "SKIPPED")
+BULK_FAILURE_WAIT = 5
+BULK_POLL_INTERVAL = 1
+# How many requests to the dcache REST API we keep in flight at once
+# when looking up many files. The lookups are dominated by the round
+# trip to the server, so overlapping them is where the time goes
+CURL_CONCURRENCY = 64
+# Where we remember the QoS of files we've looked up recently, and for
+# how long (in seconds) we trust what we remembered
+QOS_CACHE_FILE = os.path.expanduser("~/.cache/fnal_cache_list/qos.json")
+QOS_CACHE_TTL = 300
+# If at least this many of the files we're looking up live in the same
+# directory, ask dcache for the QoS of everything in that directory in
+# one request instead of asking file-by-file
+DIR_BATCH_THRESHOLD = 100
+# How many worker processes do the pnfs dot-file lookups, and how many
+# files we hand each one at a time. Each lookup is a round trip to the
+# dcache NFS server, so like the REST lookups, they're worth
+# overlapping, and there can usefully be more workers than cores
+try:
+    PNFS_CONCURRENCY = min(32, multiprocessing.cpu_count() * 4)
+except NotImplementedError:
+    PNFS_CONCURRENCY = 4
+PNFS_CHUNKSIZE = 256
+# Below this many files, starting the worker processes costs more than
+# it saves, so we do the lookups in this process
+PNFS_POOL_MIN_FILES = 64
+# The SAM experiment we ask about files, and how many requests to SAM
+# we keep in flight at once when locating lots of files
+SAM_EXPERIMENT = "uboone"
+SAM_CONCURRENCY = 16
 
 ################################################################################
 class ProgressBar(object):
+    # Don't repaint the progress line more often than this (in seconds)
+    min_interval = 0.1
+    # time.monotonic() isn't in python 2, where we make do with the
+    # wall clock
+    _clock = staticmethod(getattr(time, "monotonic", time.time))
+
     def __init__(self, total, announce_threshold=50):
         self.total = total
-        self._total_div10 = total // 10
 
         self.announce = total >= announce_threshold
-        self._last_announce_decile = -1
+        # On a terminal we repaint one line in place. Anywhere else (eg,
+        # a log file under nohup) every repaint would pile up in the
+        # output, so instead we print a line at each 10%
+        self._repaint = sys.stdout.isatty()
+        self._last_print = 0.0
+        self._next_milestone = 0
 
         self.Update(0)
 
     def Update(self, n):
-        current_decile = None
-        if self.total > 10:
-            current_decile = n // self._total_div10
-        if self.announce:
-            if current_decile is None:
-                print( " %d" % n, end=" " )
-            if (current_decile > self._last_announce_decile or n == self.total):  # always want to announce 100%
-                curr_perc = int(n / self.total * 100)
-                print( " %d%%" % curr_perc, end=" " )
-
-                self._last_announce_decile = n // self._total_div10
-
+        if not self.announce: return
+        if self._repaint:
+            # Only repaint a few times a second, so the cost per call is
+            # one clock read. Always show the final count
+            now = self._clock()
+            if now - self._last_print < self.min_interval and n != self.total:
+                return
+            sys.stdout.write( "\rProcessed: %d/%d (%d%%)" % (n, self.total, 100 * n // self.total) )
+            sys.stdout.flush()
+            self._last_print = now
+        elif n >= self._next_milestone:
+            decile = 10 * n // self.total
+            print( "Processed: %d/%d (%d%%)" % (n, self.total, 100 * n // self.total) )
             sys.stdout.flush()
+            # The first n at the next 10%, or never again once we're done
+            self._next_milestone = -(-self.total * (decile + 1) // 10) if decile < 10 else float("inf")
+
+################################################################################
+class QosCache(object):
+    """On-disk cache of the (locality, targetQos) of files looked up via
+    the dcache REST API, keyed by namespace path.
+
+    An online file with no outstanding prestage request is unlikely to
+    change on the scale of minutes, so this saves going back to dcache
+    for every such file when the script is rerun on an overlapping list
+    of files. Entries older than `ttl` seconds are ignored"""
+    def __init__(self, path=QOS_CACHE_FILE, ttl=QOS_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._dirty = False
+        self._entries = {}
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            # Missing or corrupt cache file. Just start from scratch
+            return
+
+        # Keep only the entries that look like what set() writes and
+        # haven't expired, in case the file has been mangled somehow
+        if not isinstance(entries, dict): return
+        now = time.time()
+        for k, v in entries.items():
+            if (isinstance(v, list) and len(v) == 3
+                and isinstance(v[0], (int, float)) and now - v[0] < ttl):
+                self._entries[k] = v
+
+    def get(self, path):
+        """Returns the cached (locality, targetQos) of the file at namespace
+        path `path`, or None if we don't have it"""
+        entry = self._entries.get(path)
+        if entry is None or time.time() - entry[0] >= self.ttl:
+            return None
+        return (entry[1], entry[2])
+
+    def set(self, path, qos):
+        locality, targetQos = qos
+        self._entries[path] = [time.time(), locality, targetQos]
+        self._dirty = True
+
+    def invalidate(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """Write the cache back to disk, if anything changed. The cache is
+        only an optimization, so if it can't be written (eg, read-only
+        home directory), we just carry on without it"""
+        if not self._dirty: return
+        # Write to a temporary file and move it into place, so a
+        # concurrent run never sees a half-written cache
+        tmp = "%s.%d" % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, "w") as f:
+                json.dump(self._entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except (IOError, OSError):
+                pass
+            return
+        self._dirty = False
+
+################################################################################
+_curl_share = None
+
+def get_curl_share():
+    """Returns the pycurl.CurlShare that all our curl objects use.
+
+    Curl objects in the same CurlMulti already share connections, but
+    each new CurlMulti (and each lone Curl) would otherwise start from
+    cold. Sharing the DNS cache, TLS sessions and (where libcurl is new
+    enough) the connection cache means we only pay for the lookup and
+    handshake with the dcache server once per run"""
+    global _curl_share
+    if _curl_share is None:
+        _curl_share = pycurl.CurlShare()
+        _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+            _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+    return _curl_share
 
 ################################################################################
 def make_curl():
@@ -64,9 +235,11 @@ def make_curl():
 
     The object can be reused for multiple requests to the
     dcache REST API and curl will reuse the connection, which should speed
-    things up"""
+    things up. All the objects share DNS, TLS session and connection
+    caches via get_curl_share()"""
     
     c = pycurl.Curl()
+    c.setopt(c.SHARE, get_curl_share())
     c.setopt(c.CAINFO, X509_USER_PROXY);
     c.setopt(c.SSLCERT, X509_USER_PROXY);
     c.setopt(c.SSLKEY, X509_USER_PROXY);
@@ -77,33 +250,25 @@ def make_curl():
     return c
 
 ################################################################################
+# Prefixes that files can come to us with, and what to replace each
+# with to get the path in the dcache namespace
+NAMESPACE_PREFIXES = (
+    ("root://fndca1.fnal.gov:1094", ""),
+    ("/pnfs/uboone", "/pnfs/fnal.gov/usr/uboone"),
+    ("enstore:/pnfs/uboone", "/pnfs/fnal.gov/usr/uboone"),
+)
+
 def filename_to_namespace(filename):
-    filename_out=filename
-    if filename.startswith("root://fndca1.fnal.gov:1094"):
-        filename_out=filename.replace("root://fndca1.fnal.gov:1094", "")
-    elif filename.startswith("/pnfs/uboone"):
-        filename_out=filename.replace("/pnfs/uboone", "/pnfs/fnal.gov/usr/uboone")
-    elif filename.startswith("enstore:/pnfs/uboone"):
-        filename_out=filename.replace("enstore:/pnfs/uboone", "/pnfs/fnal.gov/usr/uboone")
+    for prefix, replacement in NAMESPACE_PREFIXES:
+        if filename.startswith(prefix):
+            return replacement + filename[len(prefix):]
 
-    return filename_out
+    return filename
 
 ################################################################################
-def get_file_qos(c, filename):
-    """Using curl object `c`, find the "QoS" of `filename`.
-
-    QoS is "disk", "tape" or "disk+tape", with the obvious meanings
-
-    Returns: (currentQos, targetQos) where targetQos is non-empty if
-             there is an outstanding prestage request. currentQos will
-             be empty if there is an error (eg, file does not exist)
-    
-    Uses the dcache REST API frontend, documented in the dcache User Guide, eg:
-
-    https://www.dcache.org/manuals/UserGuide-6.0/frontend.shtml
-
-    """
-
+def qos_url(path):
+    """The dcache REST API URL that gives the QoS of the file at
+    namespace path `path` (see filename_to_namespace())"""
     # qos=true in the URL causes dcache to tell us whether the file's
     # on disk or tape, and also the "targetQos", which exists if
     # there's an outstanding prestage request.
@@ -114,36 +279,233 @@ def get_file_qos(c, filename):
     # fileLocality for the online-ness of the file, but still request
     # qos because it gives us the target qos if there's an outstanding
     # prestage request
-    url="{host}/{path}?qos=true&locality=true".format(host=DCACHE_REST_BASE_URL, path=filename_to_namespace(filename))
-    c.setopt(c.URL, url)
-    mybuffer = BytesIO()
-    c.setopt(c.WRITEFUNCTION, mybuffer.write)
-    c.perform()
+    return _NAMESPACE_URL_PREFIX + path + _QOS_URL_SUFFIX
 
-    # Body is a byte string.
-    # We have to know the encoding in order to print it to a text file
-    # such as standard output.
-    body = mybuffer.getvalue().decode('iso-8859-1')
-    
-    j=json.loads(body)
+################################################################################
+def parse_qos(body):
+    """Parse the (locality, targetQos) out of the raw response `body` to a
+    request made to qos_url()"""
+
+    # We get one of these per file, and only want two fields out of
+    # it, so rather than parse the whole JSON object, just scan the
+    # body (a byte string) for the fields we want
+    m=FILE_LOCALITY_PATTERN.search(body)
+    locality=m.group(1).decode('iso-8859-1') if m else ""
+    m=TARGET_QOS_PATTERN.search(body)
+    targetQos=m.group(1).decode('iso-8859-1') if m else ""
+
+    return (locality, targetQos)
+
+################################################################################
+def qos_from_json(j):
+    """Pull the (locality, targetQos) out of the decoded JSON object `j`
+    describing one file"""
     qos=""
     locality=""
     targetQos=""
-    # "qos" turns out to not quite be right - see comment above
+    # "qos" turns out to not quite be right - see comment in qos_url()
     # if "currentQos" in j:
     #    qos=j["currentQos"]
     if "fileLocality" in j:
         locality=j["fileLocality"]
     if "targetQos" in j:
         targetQos=j["targetQos"]
-        
+
     return (locality, targetQos)
 
+################################################################################
+def dir_qos_url(directory):
+    """The dcache REST API URL that lists the QoS of every file in the
+    namespace directory `directory`"""
+    return _NAMESPACE_URL_PREFIX + directory + _DIR_QOS_URL_SUFFIX
+
+################################################################################
+def parse_dir_qos(body):
+    """Parse the raw response `body` to a request made to dir_qos_url()
+    into a dict of {filename: (locality, targetQos)}"""
+    # If we got something other than a listing (eg, an error page from
+    # a proxy), return nothing, so the caller asks about each file
+    # individually instead
+    try:
+        j=json_loads(body)
+        return dict((child["fileName"], qos_from_json(child)) for child in j.get("children", []) if "fileName" in child)
+    except (ValueError, AttributeError, TypeError):
+        return {}
+
+################################################################################
+def get_file_qos(c, filename):
+    """Using curl object `c`, find the "QoS" of `filename`.
+
+    QoS is "disk", "tape" or "disk+tape", with the obvious meanings
+
+    Returns: (currentQos, targetQos) where targetQos is non-empty if
+             there is an outstanding prestage request. currentQos will
+             be empty if there is an error (eg, file does not exist)
+    
+    Uses the dcache REST API frontend, documented in the dcache User Guide, eg:
+
+    https://www.dcache.org/manuals/UserGuide-6.0/frontend.shtml
+
+    """
+    c.setopt(c.URL, qos_url(filename_to_namespace(filename)))
+    mybuffer = BytesIO()
+    c.setopt(c.WRITEFUNCTION, mybuffer.write)
+    c.perform()
+
+    return parse_qos(mybuffer.getvalue())
+
+################################################################################
+def curl_multi_perform(urls, postfields=None, concurrency=CURL_CONCURRENCY):
+    """Fetch each of `urls` from the dcache REST API, keeping up to
+    `concurrency` requests in flight at once. If `postfields` is
+    given, each request is a JSON POST with that body instead of a GET.
+
+    Yields (index, body) pairs in the order the requests complete,
+    where `index` is the position of the URL in `urls` and `body` is
+    the raw byte string of the response. Raises pycurl.error if any
+    transfer fails, just like Curl.perform() would.
+
+    The curl objects are recycled onto the next URL as each one
+    finishes, and they all share libcurl's connection cache, so we
+    don't pay for a new TLS handshake on every request"""
+
+    if not urls: return
+
+    multi = pycurl.CurlMulti()
+    free = [make_curl() for _ in range(min(concurrency, len(urls)))]
+    for c in free:
+        # Each curl object keeps one buffer for its whole life, which
+        # we empty before each request
+        c.buffer = BytesIO()
+        c.setopt(c.WRITEFUNCTION, c.buffer.write)
+        if postfields is not None: set_json_post(c, postfields)
+    handles = list(free)
+    todo = deque(enumerate(urls))
+    active = 0
+
+    try:
+        while todo or active:
+            # Hand out new work to any idle curl objects
+            while free and todo:
+                c = free.pop()
+                c.index, url = todo.popleft()
+                c.buffer.seek(0)
+                c.buffer.truncate()
+                c.setopt(c.URL, url)
+                multi.add_handle(c)
+                active += 1
+
+            while True:
+                ret, _ = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM: break
+
+            # Collect whatever finished
+            while True:
+                n_queued, ok_list, err_list = multi.info_read()
+                for c, errno, errmsg in err_list:
+                    raise pycurl.error(errno, errmsg)
+                for c in ok_list:
+                    multi.remove_handle(c)
+                    active -= 1
+                    free.append(c)
+                    yield c.index, c.buffer.getvalue()
+                if n_queued == 0: break
+
+            if active: multi.select(1.0)
+    finally:
+        # Closing a curl object also takes it off the multi stack
+        for c in handles: c.close()
+        multi.close()
+
+################################################################################
+def get_files_qos(files, qos_cache=None):
+    """Find the QoS of each of `files`, as returned by get_file_qos().
+
+    Yields (index, (locality, targetQos)) pairs, where `index` is the
+    position of the file in `files`, not necessarily in order. Files
+    found in `qos_cache` aren't looked up again, and the cache is
+    updated with the files that are"""
+
+    # Work out each file's namespace path once, up front, and carry it
+    # around with the file's index from here on
+    todo = []
+    for i, f in enumerate(files):
+        path = filename_to_namespace(f)
+        qos = qos_cache.get(path) if qos_cache is not None else None
+        if qos is None:
+            todo.append((i, path))
+        else:
+            yield i, qos
+
+    def remember(path, qos):
+        # Only remember files that are online with no prestage pending.
+        # Anything else (including errors, where the locality is empty)
+        # is exactly what someone polling after a prestage expects to
+        # change
+        locality, targetQos = qos
+        if qos_cache is not None and "ONLINE" in locality and not targetQos:
+            qos_cache.set(path, qos)
+
+    # Where lots of the files share a directory (the usual case for a
+    # dataset), one listing of the directory gets us all of them
+    by_dir = {}
+    for i, path in todo:
+        by_dir.setdefault(os.path.dirname(path), []).append((i, path))
+    batched = [d for d, dir_files in by_dir.items() if len(dir_files) >= DIR_BATCH_THRESHOLD]
+    todo = [ip for d, dir_files in by_dir.items() if len(dir_files) < DIR_BATCH_THRESHOLD for ip in dir_files]
+
+    for j, body in curl_multi_perform([dir_qos_url(d) for d in batched]):
+        children = parse_dir_qos(body)
+        for i, path in by_dir[batched[j]]:
+            qos = children.get(os.path.basename(path))
+            if qos is None:
+                # Not in the listing. Ask about it directly below, so
+                # we get the same answer as we would have anyway
+                todo.append((i, path))
+            else:
+                remember(path, qos)
+                yield i, qos
+
+    # The lookups are independent, so let curl overlap them. Results
+    # come back in whatever order the server answers
+    for j, body in curl_multi_perform([qos_url(path) for i, path in todo]):
+        i, path = todo[j]
+        qos = parse_qos(body)
+        remember(path, qos)
+        yield i, qos
+
 ################################################################################
 def is_file_online(c, filename):
     """Using curl object `c`, returns whether `filename` is online"""
     return "ONLINE" in get_file_qos(c, filename)[0]
 
+################################################################################
+# The body of the POST request that asks dcache to prestage a file
+PRESTAGE_POSTFIELDS = """{"action" : "qos", "target" : "disk+tape"}"""
+# The headers for all our JSON POST requests
+JSON_POST_HEADERS = ["Accept: application/json", "Content-Type: application/json"]
+
+################################################################################
+def set_json_post(c, postfields):
+    """Set up curl object `c` to POST the JSON string `postfields`"""
+    c.setopt(c.POSTFIELDS, postfields)
+    c.setopt(c.HTTPHEADER, JSON_POST_HEADERS)
+    c.setopt(c.POST, 1)
+
+################################################################################
+def prestage_url(path):
+    """The dcache REST API URL to POST to to request a prestage of the
+    file at namespace path `path`"""
+    return _NAMESPACE_URL_PREFIX + path
+
+################################################################################
+def parse_prestage(body):
+    """Parse the raw response `body` to a prestage request, returning
+    whether the request succeeded (according to dcache)"""
+
+    j=json_loads(body)
+    return "status" in j and j["status"]=="success"
+
 ################################################################################
 def request_prestage(c, filename):
     """Using curl object `c`, request a prestage for `filename`
@@ -158,71 +520,179 @@ def request_prestage(c, filename):
 
     https://www.dcache.org/manuals/UserGuide-6.0/frontend.shtml
     """
-    c.setopt(c.POSTFIELDS, """{"action" : "qos", "target" : "disk+tape"}""")
-    c.setopt(c.HTTPHEADER, ["Accept: application/json", "Content-Type: application/json"])
-    c.setopt(c.POST, 1)
-    c.setopt(c.URL, "{host}/{path}".format(host=DCACHE_REST_BASE_URL, path=filename_to_namespace(filename)))
+    set_json_post(c, PRESTAGE_POSTFIELDS)
+    c.setopt(c.URL, prestage_url(filename_to_namespace(filename)))
     mybuffer = BytesIO()
     c.setopt(c.WRITEFUNCTION, mybuffer.write)
     c.perform()
 
-    # Body is a byte string.
-    # We have to know the encoding in order to print it to a text file
-    # such as standard output.
-    body = mybuffer.getvalue().decode('iso-8859-1')
-    j=json.loads(body)
-    return "status" in j and j["status"]=="success"
+    return parse_prestage(mybuffer.getvalue())
+
+################################################################################
+def submit_bulk_prestage(c, paths):
+    """Using curl object `c`, ask dcache to prestage all of the files at
+    namespace paths `paths` with a single bulk request.
+
+    Like request_prestage(), this asks for the files' QoS to change to
+    "disk+tape" (rather than, say, pinning them), so they show up with
+    a targetQos, ie as pending, until they arrive on disk.
+
+    Returns the URL of the bulk request, which can be queried for its
+    progress, or None if dcache didn't accept the request (eg, because
+    the bulk API isn't available, or we couldn't reach it at all)"""
+    postfields = json.dumps({"activity" : "UPDATE_QOS",
+                             "arguments" : {"targetQos" : "disk+tape"},
+                             "target" : list(paths)})
+    set_json_post(c, postfields)
+    c.setopt(c.URL, DCACHE_BULK_REQUESTS_URL)
+    mybuffer = BytesIO()
+    c.setopt(c.WRITEFUNCTION, mybuffer.write)
+    # dcache tells us where the new request lives in a response header
+    headers = {}
+    def header_line(line):
+        name, sep, value = line.decode('iso-8859-1').partition(":")
+        if sep: headers[name.strip().lower()] = value.strip()
+    c.setopt(c.HEADERFUNCTION, header_line)
+    try:
+        c.perform()
+    except pycurl.error:
+        return None
+    finally:
+        c.setopt(c.HEADERFUNCTION, lambda line: None)
+
+    if c.getinfo(c.RESPONSE_CODE) not in (200, 201):
+        return None
+    # Without the URL we have no way to check on the request, so treat
+    # that as a failure too
+    return headers.get("request-url", headers.get("location"))
+
+################################################################################
+def get_bulk_target_states(c, request_url):
+    """Using curl object `c`, find the state of each file in the bulk
+    request at `request_url`, as returned by submit_bulk_prestage().
+
+    Returns a dict of {namespace path: state}, where state is eg
+    "RUNNING", "COMPLETED" or "FAILED". Files we couldn't find out
+    about (including all of them, if we couldn't reach dcache or didn't
+    understand its answer) are left out
+    """
+    c.setopt(c.HTTPGET, 1)
+    c.setopt(c.URL, request_url)
+    mybuffer = BytesIO()
+    c.setopt(c.WRITEFUNCTION, mybuffer.write)
+    try:
+        c.perform()
+        j=json_loads(mybuffer.getvalue())
+        return dict((t["target"], t.get("state", "")) for t in j.get("targets", []) if "target" in t)
+    except (pycurl.error, ValueError, AttributeError, TypeError):
+        return {}
 
 ################################################################################
 def is_file_online_pnfs(f):
     path, filename = os.path.split(f)
     stat_file="%s/.(get)(%s)(locality)"%(path,filename)
-    theStatFile=open(stat_file)
-    state=theStatFile.readline()
-    theStatFile.close()
-    return 'ONLINE' in state
+    # The dot-file just holds the locality, eg "ONLINE_AND_NEARLINE",
+    # so skip the buffered/text file machinery and read a few raw bytes
+    fd=os.open(stat_file, os.O_RDONLY)
+    try:
+        state=os.read(fd, 64)
+    finally:
+        os.close(fd)
+    return b'ONLINE' in state
+
+################################################################################
+def pnfs_status(item):
+    """Given an (index, f) pair, returns (index, is_file_online_pnfs(f)),
+    for use with Pool.imap_unordered()"""
+    i, f = item
+    return i, is_file_online_pnfs(f)
+
+################################################################################
+def pnfs_statuses(files):
+    """Yields (index, online) pairs for each of `files`, where `index` is
+    the position of the file in `files`, not necessarily in order,
+    spreading the work over up to PNFS_CONCURRENCY processes.
+
+    Each lookup is independent, so many can be outstanding at once.
+    Most of the time goes waiting on NFS, which doesn't hold the GIL,
+    but the Python work around each lookup does, and separate processes
+    let that run on several cores too"""
+    pool = None
+    if len(files) >= PNFS_POOL_MIN_FILES:
+        nproc = min(PNFS_CONCURRENCY, len(files))
+        try:
+            pool = multiprocessing.Pool(nproc)
+        except (OSError, ImportError):
+            # We can't start worker processes here (eg, no /dev/shm)
+            pass
+
+    if pool is None:
+        # Not worth a pool, or can't have one: do the lookups ourselves
+        for item in enumerate(files):
+            yield pnfs_status(item)
+        return
+
+    try:
+        # Big chunks keep the interprocess traffic down, but not so big
+        # that a short list of files ends up all on one worker
+        chunksize = max(1, min(PNFS_CHUNKSIZE, len(files) // nproc))
+        for result in pool.imap_unordered(pnfs_status, enumerate(files), chunksize):
+            yield result
+    finally:
+        pool.terminate()
 
 ################################################################################
-def FilelistCacheCount(files, verbose_flag, METHOD="rest"):
+def FilelistCacheCount(files, verbose_flag, METHOD="rest", qos_cache=None):
     assert(METHOD in ("rest", "pnfs"))
 
     if len(files) > 1:
         print( "Checking %d files:" % len(files) )
-    cached = 0
-    cache_list = []
-    pending = 0
+    # Results come back out of order, so flag each file by its index
+    # as we go, and count them up at the end
+    is_cached = bytearray(len(files))
+    is_pending = bytearray(len(files))
     n = 0
 
     # If we're in verbose mode, the per-file output fights with
     # the progress bar, so disable the progress bar
     progbar = None if verbose_flag else ProgressBar(len(files)) 
 
-    c=make_curl() if METHOD=="rest" else None
-    
-    for f in files:
-        if METHOD=="rest":
-            qos,targetQos=get_file_qos(c, f)
-            if "ONLINE" in qos: 
-                cached += 1
-                cache_list.append(f)
-            if "disk" in targetQos: pending += 1
+    # The per-file verbose output should still be in the order of
+    # `files`, so hold on to each file's line until all the files
+    # before it have been printed. (A list rather than a plain int so
+    # show() can update it under python 2)
+    held_lines = {}
+    next_line = [0]
+    def show(i, *fields):
+        held_lines[i] = fields
+        while next_line[0] in held_lines:
+            print( *held_lines.pop(next_line[0]) )
+            next_line[0] += 1
+
+    if METHOD=="rest":
+        for i, (qos,targetQos) in get_files_qos(files, qos_cache):
+            if "ONLINE" in qos: is_cached[i] = 1
+            if "disk" in targetQos: is_pending[i] = 1
             if verbose_flag:
-                print( f, qos, "pending" if targetQos else "")
-        elif METHOD=="pnfs":
-            this_cached=is_file_online_pnfs(f)
-            if this_cached: 
-                cached += 1
-                cache_list.append(f)
+                show( i, files[i], qos, "pending" if targetQos else "")
+
+            n += 1
+            if not verbose_flag: progbar.Update(n)
+    elif METHOD=="pnfs":
+        for i, this_cached in pnfs_statuses(files):
+            if this_cached: is_cached[i] = 1
             if verbose_flag:
-                print( f, "ONLINE" if this_cached else "NEARLINE")
+                show( i, files[i], "ONLINE" if this_cached else "NEARLINE")
 
-        n += 1
-        # If we're in verbose mode, the per-file output fights with
-        # the progress bar, so disable the progress bar
-        if not verbose_flag: progbar.Update(n)
+            n += 1
+            if not verbose_flag: progbar.Update(n)
 
     if not verbose_flag: progbar.Update(progbar.total)
 
+    cached = sum(is_cached)
+    pending = sum(is_pending)
+    cache_list = [f for f, c in zip(files, is_cached) if c]
+
     # We don't count pending files with the pnfs method, so set it to
     # something meaningless
     if METHOD=="pnfs":
@@ -230,36 +700,120 @@ def FilelistCacheCount(files, verbose_flag, METHOD="rest"):
     return (cached, pending, n, cache_list)
 
 ################################################################################
-def FilelistPrestageRequest(files, verbose_flag):
+def FilelistPrestageRequest(files, verbose_flag, qos_cache=None):
     announce=len(files) > 1
     if announce:
         print( "Prestaging %d files:" % len(files) )
 
-    c=make_curl()
     n = len(files)
     n_request_succeeded = 0
-    for f in files:
-        success=request_prestage(c, f)
-        if success: n_request_succeeded += 1
+
+    # Work out each file's namespace path once, up front
+    paths = [filename_to_namespace(f) for f in files]
+
+    def record(i, success, message=None):
+        f = files[i]
+        # Whatever we knew about this file's QoS is about to be out of date
+        if qos_cache is not None: qos_cache.invalidate(paths[i])
         if verbose_flag:
-            print( f, "request succeeded" if success else "request failed" )
+            print( f, message or ("request succeeded" if success else "request failed") )
+
+    # Ask for the files in big chunks with the bulk API. If dcache
+    # won't take a bulk request, don't keep trying: fall back to
+    # asking for the remaining files one by one
+    first_remaining = 0
+    if files:
+        c=make_curl()
+        submitted = []  # (request_url, [file indices]) for each accepted bulk request
+        while first_remaining < n:
+            chunk = list(range(first_remaining, min(first_remaining + BULK_PRESTAGE_CHUNK, n)))
+            request_url = submit_bulk_prestage(c, [paths[i] for i in chunk])
+            if request_url is None:
+                if verbose_flag:
+                    print( "Bulk prestage request failed. Requesting files individually" )
+                break
+            if verbose_flag:
+                print( "Submitted bulk prestage request", request_url )
+            submitted.append((request_url, chunk))
+            first_remaining += len(chunk)
+
+        # Every file dcache accepted counts as a success, just as with
+        # the per-file requests, unless it fails straight away (eg, the
+        # file doesn't exist). Stop watching as soon as dcache has
+        # started on, or given up on, everything
+        failed = set()
+        deadline = time.time() + BULK_FAILURE_WAIT
+        while True:
+            all_started = True
+            for request_url, chunk in submitted:
+                states = get_bulk_target_states(c, request_url)
+                for i in chunk:
+                    state = states.get(paths[i], "")
+                    if state in BULK_FAILED_STATES:
+                        failed.add(i)
+                    elif state not in BULK_STARTED_STATES:
+                        all_started = False
+            if all_started or time.time() >= deadline: break
+            time.sleep(BULK_POLL_INTERVAL)
+
+        for request_url, chunk in submitted:
+            for i in chunk:
+                success = i not in failed
+                if success: n_request_succeeded += 1
+                record(i, success)
+        c.close()
+
+    # As in FilelistCacheCount, the requests are independent, so we
+    # overlap them rather than waiting on each in turn
+    for i, body in curl_multi_perform([prestage_url(path) for path in paths[first_remaining:]], PRESTAGE_POSTFIELDS):
+        success=parse_prestage(body)
+        if success: n_request_succeeded += 1
+        record(first_remaining + i, success)
 
     return (n_request_succeeded, n)
 
+################################################################################
+def locate_files(files, experiment=SAM_EXPERIMENT):
+    """Run samweb's locateFile() on each of `files`, with up to
+    SAM_CONCURRENCY requests in flight at once.
+
+    Yields (filename, locations) pairs in the order of `files`. Each
+    worker thread gets its own SAMWebClient, since we can't count on
+    one being safe to share between threads"""
+    if not files: return
+
+    local = threading.local()
+    def locate(f):
+        if not hasattr(local, "sam"):
+            local.sam = swc.SAMWebClient(experiment)
+        return f, local.sam.locateFile(f)
+
+    pool = ThreadPool(min(SAM_CONCURRENCY, len(files)))
+    try:
+        for result in pool.imap(locate, files):
+            yield result
+    finally:
+        pool.terminate()
+
 ################################################################################
 def enstore_locations_to_paths(samlist, sparsification=1):
     """Convert a list of enstore locations as returned by
        samweb.listFilesAndLocations() into plain pnfs paths. Sparsify by
        `sparsification`"""
+    # This runs over every file in a dataset, so keep the loop lean:
+    # look the method up once, don't copy samlist to sparsify it, and
+    # pick the location apart with string methods rather than
+    # ENSTORE_PATTERN (which matches the same thing)
     pnfspaths=[]
-    for f in samlist[::sparsification]:
-        m=ENSTORE_PATTERN.match(f[0])
-        if m:
-            directory=m.group(1)
-            filename=f[1]
-            pnfspaths.append(os.path.join(directory, filename))
+    append=pnfspaths.append
+    for location, filename in islice(samlist, 0, None, sparsification):
+        directory = location[8:].split("(", 1)[0] if location.startswith("enstore:") else ""
+        if directory:
+            # Same as os.path.join for these absolute directories,
+            # including ones that come with a trailing slash, but cheaper
+            append(directory.rstrip("/") + "/" + filename)
         else:
-            print( "enstore_locations_to_paths got a non-enstore location", f[0] )
+            print( "enstore_locations_to_paths got a non-enstore location", location )
     return pnfspaths
 
 examples="""
@@ -322,6 +876,7 @@ if __name__=="__main__":
     parser.add_argument("-v","--verbose", action="store_true", dest="verbose", default=False, help="Print information about individual files")
     parser.add_argument("-p","--prestage", action="store_true", dest="prestage", default=False, help="Prestage the files specified")
     parser.add_argument("-m", "--method", choices=["rest", "pnfs"], default="rest", help="Use this method to look up file status.")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache", default=False, help="Always ask dcache for the status of each file, rather than reusing answers from the last %d seconds (stored in %s)" % (QOS_CACHE_TTL, QOS_CACHE_FILE))
 
     args=parser.parse_args()
 
@@ -336,7 +891,7 @@ if __name__=="__main__":
 
     filelist = None if args.dataset_name else args.files
 
-    sam = swc.SAMWebClient("uboone")
+    sam = swc.SAMWebClient(SAM_EXPERIMENT)
 
     cache_count = 0
 
@@ -359,15 +914,12 @@ if __name__=="__main__":
                 thislist = sam.listFiles(defname=args.dataset_name)
                 print(len(thislist))
                 samlist = []
-                a = 0
-                for f in thislist:
+                for a, (f, locs) in enumerate(locate_files(thislist)):
                   if not (a%100): print("Locating files: %i/%i"%(a, len(thislist)), end='\r')
-                  locs = sam.locateFile(f)
                   for l in locs:
                     if l['full_path'].split(':')[0] == 'enstore':
                       samlist.append((l['full_path'], f))
                       break 
-                  a += 1
                 print()
                 print(len(samlist))
 
@@ -393,7 +945,12 @@ if __name__=="__main__":
             print( 'Unable to retrieve SAM information for dimensions: %s' %(args.dimensions) )
             exit(-1)
     else:
-        filelist=[]
+        # One list of paths per argument, so the files stay in the
+        # order they were given even though we locate the SAM ones
+        # separately
+        slots=[]
+        sam_filenames=[]
+        sam_slots=[]
         # We were passed a list of files. Loop over them and try to locate each one
         for f in args.files:
             if os.path.isfile(f):
@@ -401,47 +958,65 @@ if __name__=="__main__":
                 # If the file's not on pnfs, just assume it's on a
                 # regular filesystem that is always "cached". Otherwise, add it to the list
                 if f.startswith("/pnfs"):
-                    filelist.append(f)
+                    slots.append([f])
                 else:
                     cache_count += 1
                     continue
             else:
                 # The argument isn't a file on the file system. Assume
                 # it's a filename in samweb and ask samweb for the
-                # location
-                try:
-                    locs = sam.locateFile(f)
-                    # locateFile potentially produces multiple
-                    # locations. We look through them for the enstore
-                    # one, and add it to the list, but without the
-                    # "enstore:/" at the front
-                    for loc in locs:
-                        l=loc["location"]
-                        m=ENSTORE_PATTERN.match(l)
-                        if m:
-                            directory=m.group(1)
-                            fullpath=os.path.join(directory, f)
-                            filelist.append(fullpath)
-                except (swc.exceptions.FileNotFound, swc.exceptions.HTTPNotFound):
-                    print("File is not known to SAM and is not a full path:", f, file=sys.stderr)
-                    sys.exit(2)
+                # location below
+                sam_filenames.append(f)
+                sam_slots.append([])
+                slots.append(sam_slots[-1])
+
+        # Ask samweb for the locations of all the SAM filenames at once
+        n_located = 0
+        try:
+            for f, locs in locate_files(sam_filenames):
+                slot = sam_slots[n_located]
+                # locateFile potentially produces multiple
+                # locations. We look through them for the enstore
+                # one, and add it to the list, but without the
+                # "enstore:/" at the front
+                for loc in locs:
+                    l=loc["location"]
+                    m=ENSTORE_PATTERN.match(l)
+                    if m:
+                        directory=m.group(1)
+                        fullpath=os.path.join(directory, f)
+                        slot.append(fullpath)
+                n_located += 1
+        except (swc.exceptions.FileNotFound, swc.exceptions.HTTPNotFound):
+            # locate_files() gives results in order, so the failure
+            # is for the first file we didn't get a result for
+            print("File is not known to SAM and is not a full path:", sam_filenames[n_located], file=sys.stderr)
+            sys.exit(2)
+
+        filelist=[path for slot in slots for path in slot]
 
     miss_count = 0
 
     n_files = len(filelist)
     announce = n_files > 1  # some status notes if there are lots of files
 
+    qos_cache = None if args.no_cache else QosCache()
+
     if args.prestage:
-        ngood,n=FilelistPrestageRequest(filelist, args.verbose)
+        ngood,n=FilelistPrestageRequest(filelist, args.verbose, qos_cache)
+        if qos_cache is not None: qos_cache.save()
         sys.exit(0 if ngood==n else 1)
     else:
-        cache_count, pending_count, total, cache_list = FilelistCacheCount(filelist, args.verbose, args.method)
+        cache_count, pending_count, total, cache_list = FilelistCacheCount(filelist, args.verbose, args.method, qos_cache)
+        if qos_cache is not None: qos_cache.save()
         miss_count = total - cache_count
 
         # Save cache_list to a text file
+        # Build the whole thing up front and write it in one go, rather
+        # than one small write per file
         with open("cache_list.txt", "w") as f:
-            for item in cache_list:
-                f.write("%s\n" % item)
+            if cache_list:
+                f.write("\n".join(cache_list) + "\n")
 
         total = float(cache_count + miss_count)
         cache_frac_str = (" (%d%%)" % round(cache_count/total*100)) if total > 0 else ""